@@ -7,21 +7,50 @@ video2mc_datapack
  - 自适应高画质（按视频宽度缩放到 MAX_WIDTH，保持宽高比）
  - 优先使用当前目录的 ffmpeg（./ffmpeg 或 ./ffmpeg.exe）
  - 若无则使用系统 ffmpeg 或自动下载（支持 Win/Linux/Mac）
+ - 解析到的 ffmpeg 路径缓存在 ~/.cache/video2mc/ffmpeg_path.json，下次启动免探测
+   （PATH 中的 ffmpeg 变了或缓存的 ffmpeg 运行失败时自动失效，也可直接删除该文件）
  - 生成每帧单独的 function：frame_0...frame_N
  - 生成 main.mcfunction 入口
- - 将 PNG 复制到 ParticleEx 图片目录（可配置）
- - 自动打包成 zip
-依赖: pip install tqdm pillow requests
+ - 将 PNG 硬链接（不支持时复制）到 ParticleEx 图片目录（可配置）
+ - mcfunction 直接写入 zip，不生成中间数据包目录
+依赖: pip install tqdm requests
+可选: pip install isal（或 zlib-ng）加速 zip 压缩/解压
 用法:
  python video_to_mc.py input.mp4 [datapack_name]
 """
 
 from __future__ import annotations
-import os, sys, subprocess, glob, shutil, zipfile, platform, json
+import os, sys, subprocess, shutil, zipfile, platform, json, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from tqdm import tqdm
-from PIL import Image
 import requests
 
+# 可选：isal / zlib-ng 提供 SIMD 加速的 deflate，未安装则用标准库 zlib
+try:
+    from isal import isal_zlib as _fast_zlib
+except ImportError:
+    try:
+        from zlib_ng import zlib_ng as _fast_zlib
+    except ImportError:
+        _fast_zlib = None
+
+@contextmanager
+def _fast_deflate():
+    """
+    在 with 块内让 zipfile 的 deflate 压缩/解压（compressobj/decompressobj）走 _fast_zlib，
+    退出时还原。crc32 是 zipfile 导入时绑定的，仍用标准库实现
+    """
+    if _fast_zlib is None:
+        yield
+        return
+    orig = zipfile.zlib
+    zipfile.zlib = _fast_zlib
+    try:
+        yield
+    finally:
+        zipfile.zlib = orig
+
 # ---------------- 用户可配置项 ----------------
 # 输出帧率（建议 20 与 Minecraft 20 tick/s 对齐）
 FFMPEG_FPS = 20
@@ -59,13 +88,58 @@ FFMPEG_URL = {
     'Darwin':  'https://evermeet.cx/ffmpeg/ffmpeg.zip'
 }
 
+# 上次解析到的 ffmpeg 路径缓存，避免每次启动都执行 ffmpeg -version 试探
+FFMPEG_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'video2mc', 'ffmpeg_path.json')
+
+def _load_ffmpeg_cache() -> str | None:
+    """读取缓存的 ffmpeg 路径，文件不存在/损坏或路径已失效时返回 None"""
+    try:
+        with open(FFMPEG_CACHE_FILE, encoding='utf-8') as f:
+            cached = json.load(f).get('ffmpeg')
+    except (OSError, ValueError, AttributeError):
+        return None
+    return cached if isinstance(cached, str) and os.path.isfile(cached) else None
+
+def _save_ffmpeg_cache(path: str):
+    """
+    写入 ffmpeg 路径缓存；失败不影响主流程
+    每个进程用 mkstemp 建自己的临时文件再 os.replace，批量并发运行时互不覆盖
+    """
+    cache_dir = os.path.dirname(FFMPEG_CACHE_FILE)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump({'ffmpeg': os.path.abspath(path)}, f, ensure_ascii=False)
+        os.replace(tmp, FFMPEG_CACHE_FILE)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def _drop_ffmpeg_cache(path: str):
+    """缓存指向的正是 path 时删除缓存（该 ffmpeg 已无法运行），下次启动重新探测"""
+    try:
+        with open(FFMPEG_CACHE_FILE, encoding='utf-8') as f:
+            cached = json.load(f).get('ffmpeg')
+        if cached == os.path.abspath(path):
+            os.remove(FFMPEG_CACHE_FILE)
+    except (OSError, ValueError, AttributeError):
+        pass
+
 def get_ffmpeg() -> str:
     """
     获取 ffmpeg 可执行路径：
     1. 优先使用当前目录的 ffmpeg
     2. 用户手动指定 FFMPEG_PATH
-    3. 系统 PATH
-    4. 自动下载并解压
+    3. 上次解析并缓存的路径（FFMPEG_CACHE_FILE）；PATH 中找到的 ffmpeg 与缓存不同时
+       （换了环境/升级到新位置）缓存作废，按 PATH 重新探测
+    4. 系统 PATH
+    5. 自动下载并解压
     """
     local_name = 'ffmpeg.exe' if platform.system() == 'Windows' else 'ffmpeg'
     local_path = os.path.join(os.getcwd(), local_name)
@@ -73,8 +147,15 @@ def get_ffmpeg() -> str:
         return local_path
     if FFMPEG_PATH and os.path.isfile(FFMPEG_PATH):
         return FFMPEG_PATH
+    # shutil.which 只查 PATH 不起进程，用来确认缓存没有过时
+    resolved = shutil.which(local_name)
+    cached = _load_ffmpeg_cache()
+    if cached and (resolved is None or os.path.abspath(resolved) == cached):
+        return cached
     try:
         subprocess.run([local_name, '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        if resolved:
+            _save_ffmpeg_cache(resolved)
         return local_name
     except Exception:
         pass
@@ -88,103 +169,210 @@ def get_ffmpeg() -> str:
         print('正在下载 ffmpeg...')
         r = requests.get(url, stream=True)
         total = int(r.headers.get('content-length', 0) or 0)
+        r.raw.decode_content = True  # 服务器若用 gzip 传输编码，读取时自动解开
         with tqdm.wrapattr(open(local_archive, 'wb'), 'write', total=total, desc='下载 ffmpeg') as f:
-            shutil.copyfileobj(r.raw, f)
+            # 1 MiB 缓冲，几百 MB 的压缩包不再按默认的小块逐次读写
+            shutil.copyfileobj(r.raw, f, length=1 << 20)
     tmpdir = 'ffmpeg'
     os.makedirs(tmpdir, exist_ok=True)
     if local_archive.endswith('.zip'):
-        with zipfile.ZipFile(local_archive) as z:
+        with _fast_deflate(), zipfile.ZipFile(local_archive) as z:
             z.extractall(tmpdir)
     else:
         subprocess.run(['tar', '-xf', local_archive, '-C', tmpdir], check=True)
     for root, _, files in os.walk(tmpdir):
         for fname in files:
             if fname.startswith('ffmpeg') and (fname.endswith('.exe') or fname == 'ffmpeg'):
-                return os.path.join(root, fname)
+                found = os.path.join(root, fname)
+                _save_ffmpeg_cache(found)
+                return found
     raise RuntimeError('下载并解压 ffmpeg 失败')
 
+def _hardlink(src: str, dst: str):
+    os.link(src, dst)
+
+def _fastlink(src: str, dst: str, method=None):
+    """
+    把 src 放到 dst（已存在则覆盖），返回实际使用的方法：
+    - 指定 method 时直接使用，不再试探
+    - 否则先试硬链接，失败（跨盘/文件系统不支持）则 shutil.copyfile，
+      调用方用首帧的结果处理剩余帧
+    不使用符号链接：下次拆帧会 rmtree 帧目录，符号链接会全部失效
+    """
+    # 先删旧文件：os.link 不能覆盖，copyfile 遇到旧符号链接会写穿到源文件
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if method is not None:
+        method(src, dst)
+        return method
+    try:
+        _hardlink(src, dst)
+        return _hardlink
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return shutil.copyfile
+
+def _run_ffmpeg(cmd: list):
+    """运行 ffmpeg；失败时若用的是缓存里的 ffmpeg，顺手清掉缓存，避免下次继续用它"""
+    try:
+        subprocess.run(cmd, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        _drop_ffmpeg_cache(cmd[0])
+        raise
+
 def extract_frames(video: str, out_dir: str, ffmpeg_cmd: str, datapack_name='videopack'):
     """
     使用 ffmpeg 拆帧 + 缩放 + 可选颜色量化
     - scale=MAX_WIDTH:-1 让 ffmpeg 按比例缩放
     - fps=FFMPEG_FPS 保证每秒输出帧数
-    - MAX_COLORS < 256 时启用 ffmpeg -colors 限制颜色
+    - MAX_COLORS < 256 时分两遍量化：先 palettegen 生成整段视频共用的调色板，
+      再 paletteuse 套用（单遍 split 会把所有帧缓存在内存里直到视频结束）
+    - PNG 用压缩级别 1 写出：帧只被 ParticleEx 读一次，优先拆帧速度
     """
+    quantize = bool(MAX_COLORS and MAX_COLORS < 256)
+    if quantize:
+        # palettegen 的 max_colors 只接受 4~256，在清空帧目录之前先校正
+        colors = max(4, MAX_COLORS)
+        if colors != MAX_COLORS:
+            print(f'MAX_COLORS={MAX_COLORS} 小于 ffmpeg palettegen 支持的最小值，按 {colors} 色量化')
+
     if os.path.exists(out_dir):
         shutil.rmtree(out_dir)
     os.makedirs(out_dir, exist_ok=True)
 
     scale_expr = f'scale={MAX_WIDTH}:-1'
     vf_filters = [f'fps={FFMPEG_FPS}', scale_expr]
-
-    cmd = [ffmpeg_cmd, '-i', video]
-    if MAX_COLORS and MAX_COLORS < 256:
-        cmd += ['-colors', str(MAX_COLORS)]
-    cmd += [
-        '-vf', ','.join(vf_filters),
+    vf = ','.join(vf_filters)
+    out_args = [
         '-vsync', '0',
+        '-compression_level', '1',
         os.path.join(out_dir, f'{datapack_name}_%06d.png')
     ]
-    print('执行拆帧：', ' '.join(cmd))
-    subprocess.run(cmd, check=True)
+
+    if not quantize:
+        cmd = [ffmpeg_cmd, '-i', video, '-vf', vf] + out_args
+        print('执行拆帧：', ' '.join(cmd))
+        _run_ffmpeg(cmd)
+        return
+
+    # 调色板放在临时目录，不混进帧目录
+    with tempfile.TemporaryDirectory() as tmpdir:
+        palette = os.path.join(tmpdir, 'palette.png')
+        cmd = [ffmpeg_cmd, '-i', video,
+               '-vf', f'{vf},palettegen=max_colors={colors}', '-y', palette]
+        print('生成调色板：', ' '.join(cmd))
+        _run_ffmpeg(cmd)
+
+        cmd = [ffmpeg_cmd, '-i', video, '-i', palette,
+               '-lavfi', f'[0:v]{vf}[x];[x][1:v]paletteuse=dither=bayer'] + out_args
+        print('执行拆帧：', ' '.join(cmd))
+        _run_ffmpeg(cmd)
 
 def build_datapack(out_dir: str, datapack_name: str):
     """
     生成 Minecraft 数据包：
-    1. 复制 PNG 到 ParticleEx 图片目录
+    1. 链接/复制 PNG 到 ParticleEx 图片目录
     2. 生成每帧对应的 mcfunction
     3. main.mcfunction 调用第一帧
-    4. 打包成 zip
+    以上文件直接写入 zip，不在磁盘上生成数据包目录
     """
-    pngs = sorted(glob.glob(os.path.join(out_dir, '*.png')))
+    # scandir 的 DirEntry 自带 name/path，省去 glob 的逐项匹配和路径拼接
+    with os.scandir(out_dir) as it:
+        pngs = sorted((e for e in it if e.name.endswith('.png')), key=lambda e: e.name)
     if not pngs:
         print('未找到帧图片，退出。')
         return
+    total = len(pngs)
 
     os.makedirs(PARTICLEEX_IMG_DIR, exist_ok=True)
-    dp_root = datapack_name
-    func_dir = os.path.join(dp_root, 'data', datapack_name, 'functions')
-    os.makedirs(func_dir, exist_ok=True)
-
-    # 创建 pack.mcmeta
-    pack = {
-        "pack": {"pack_format": 6, "description": f"Video particle animation ({datapack_name})"}
-    }
-    with open(os.path.join(dp_root, 'pack.mcmeta'), 'w', encoding='utf-8') as f:
-        json.dump(pack, f, ensure_ascii=False, indent=2)
-
-    # main.mcfunction
-    with open(os.path.join(func_dir, 'main.mcfunction'), 'w', encoding='utf-8') as f:
-        f.write(f'function {datapack_name}:{datapack_name}_0\n')
-
-    # 每帧 mcfunction + PNG 复制
-    for i, src in enumerate(tqdm(pngs, desc='生成 mcfunction 并复制图片')):
-        name = os.path.basename(src)
-        shutil.copy2(src, os.path.join(PARTICLEEX_IMG_DIR, name))
-        mcpath = os.path.join(func_dir, f'{datapack_name}_{i}.mcfunction')
-        with open(mcpath, 'w', encoding='utf-8') as mf:
-            # particleex image <particle> <pos> <imagename> <scale> ...
-            cmd = (f'particleex image {PARTICLE} {ANCHOR_POS} {name} '
-                   f'{SCALE} 0 0 0 not {DPB} 0 0 0 {LIFETIME_TICK} "vy=0" 1.0 {GROUP}')
-            mf.write(f'execute positioned ~ ~ ~ run {cmd}\n')
-            # 调度下一帧
-            if i + 1 < len(pngs):
-                mf.write(f'schedule function {datapack_name}:{datapack_name}_{i+1} 1t\n')
-
-    # 打包 zip
+
+    # particleex image <particle> <pos> <imagename> <scale> ...
+    # 每帧只有图片名和下一帧序号不同，提前生成模板，线程里只替换这两处
+    # 配置值先转义花括号（如粒子 NBT minecraft:item minecraft:stone{...}），避免被 format 当成占位符
+    def esc(v) -> str:
+        return str(v).replace('{', '{{').replace('}', '}}')
+    ns = esc(datapack_name)
+    tmpl_last = (f'execute positioned ~ ~ ~ run particleex image {esc(PARTICLE)} {esc(ANCHOR_POS)} {{name}} '
+                 f'{esc(SCALE)} 0 0 0 not {esc(DPB)} 0 0 0 {esc(LIFETIME_TICK)} "vy=0" 1.0 {esc(GROUP)}\n')
+    # 非最后一帧：追加调度下一帧
+    tmpl = tmpl_last + f'schedule function {ns}:{ns}_{{next}} 1t\n'
+
+    # 首帧试探链接方式，链接线程里的其余帧直接沿用
+    link_method = _fastlink(pngs[0].path, os.path.join(PARTICLEEX_IMG_DIR, pngs[0].name))
+
     zipname = f'{datapack_name}.zip'
     if os.path.exists(zipname):
         os.remove(zipname)
-    with zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED) as z:
-        for root, _, files in os.walk(dp_root):
-            for fn in files:
-                absf = os.path.join(root, fn)
-                arcname = os.path.relpath(absf, dp_root)
-                z.write(absf, arcname)
-
-    print(f'数据包已生成：{dp_root}')
-    print(f'ZIP 文件：{zipname}')
-    print(f'PNG 已复制到：{PARTICLEEX_IMG_DIR}')
+    func_arc = f'data/{datapack_name}/functions/'
+    # 每帧在 zip 中的路径一次性生成，循环里按序号取用
+    arcnames = [f'{func_arc}{datapack_name}_{i}.mcfunction' for i in range(total)]
+
+    # 任一线程出错（或主线程被中断）时置位，另一个线程随即停下
+    stop = threading.Event()
+
+    def _link_frames(bar):
+        """链接线程：只负责把 PNG 放进 ParticleEx 图片目录，进度记在自己的 bar 上"""
+        try:
+            for entry in pngs[1:]:  # 首帧已在试探时放好
+                if stop.is_set():
+                    return
+                _fastlink(entry.path, os.path.join(PARTICLEEX_IMG_DIR, entry.name), link_method)
+                bar.update()
+        except BaseException:
+            stop.set()
+            raise
+
+    def _write_functions(z: zipfile.ZipFile, bar):
+        """写 zip 线程：独占 ZipFile（非线程安全），按序写入每帧 mcfunction，进度记在自己的 bar 上"""
+        try:
+            for i, entry in enumerate(pngs):
+                if stop.is_set():
+                    return
+                if i + 1 < total:
+                    body = tmpl.format(name=entry.name, next=i + 1)
+                else:
+                    body = tmpl_last.format(name=entry.name)
+                z.writestr(arcnames[i], body)
+                bar.update()
+        except BaseException:
+            stop.set()
+            raise
+
+    # 图片目录和 zip 通常不在同一块盘上，两路 I/O 各用一个线程并行
+    # zip 里只有很短的文本（PNG 不进 zip），压缩级别 1 体积几乎不变但快得多
+    try:
+        with _fast_deflate(), \
+                zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as z, \
+                ThreadPoolExecutor(max_workers=2) as ex:
+            # 创建 pack.mcmeta
+            pack = {
+                "pack": {"pack_format": 6, "description": f"Video particle animation ({datapack_name})"}
+            }
+            z.writestr('pack.mcmeta', json.dumps(pack, ensure_ascii=False, indent=2))
+
+            # main.mcfunction
+            z.writestr(func_arc + 'main.mcfunction', f'function {datapack_name}:{datapack_name}_0\n')
+
+            # 每帧 PNG 链接 + mcfunction，各线程一条进度条，两个线程都结束后才关闭 zip
+            with tqdm(total=total, initial=1, desc='链接图片', position=0) as link_bar, \
+                    tqdm(total=total, desc='生成 mcfunction', position=1) as func_bar:
+                futures = [ex.submit(_link_frames, link_bar), ex.submit(_write_functions, z, func_bar)]
+                try:
+                    for fut in futures:
+                        fut.result()  # 等待完成，同时把线程里的异常抛出来
+                except BaseException:
+                    stop.set()  # 如 Ctrl+C：让工作线程尽快退出，不必跑完剩余帧
+                    raise
+    except BaseException:
+        # ZipFile 退出时仍会写出一个结构完整的 zip，删掉它，免得留下看似可用的残缺数据包
+        if os.path.exists(zipname):
+            os.remove(zipname)
+        raise
+
+    print(f'数据包已生成：{zipname}')
+    action = '硬链接' if link_method is _hardlink else '复制'
+    print(f'PNG 已{action}到：{PARTICLEEX_IMG_DIR}')
     print(f'进游戏 /reload，然后 /function {datapack_name}:main')
 
 def main():